@@ -1,6 +1,6 @@
 # main.py
 """
-Attendance Bot with FastAPI webhook (python-telegram-bot v13.15)
+Attendance Bot with FastAPI webhook (python-telegram-bot v20, asyncio)
 
 ✅ Features:
  - Inline buttons: Work / Off / Eat / Toilet / Smoke / Meeting / Back
@@ -11,29 +11,41 @@ Attendance Bot with FastAPI webhook (python-telegram-bot v13.15)
  - /report and /fine admin commands
  - Multilingual: /zh /en /km
  - Auto-leaves if added by non-admin
- - Runs 24/7 with FastAPI + uvicorn
+ - Runs 24/7 with FastAPI + uvicorn (single worker: timers and jobs live in-process)
 """
 
 import os
 import logging
+import contextlib
 import datetime
-from typing import Dict, Any
+import itertools
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Any, DefaultDict, List, Optional, Tuple
 from fastapi import FastAPI, Request
 import asyncio
+import msgspec
 
-from telegram import (
-    Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
-)
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
-    Dispatcher, CommandHandler, CallbackQueryHandler,
-    CallbackContext, MessageHandler, Filters, JobQueue
+    Application, CommandHandler, CallbackQueryHandler,
+    ContextTypes, MessageHandler, filters
 )
 
 # ================= CONFIG =================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://your-app.onrender.com/webhook")
+SHUTDOWN_DRAIN_SEC = 10.0
+STATE_DB = os.getenv("STATE_DB", "state.db")
+STATE_FLUSH_SEC = 0.2
+TG_CONNECTION_POOL_SIZE = 100
+TG_POOL_TIMEOUT_SEC = 10.0
 
-ADMIN_USER_IDS = {7124683213}   # your Telegram ID(s)
+ADMIN_USER_IDS = frozenset({7124683213})   # your Telegram ID(s)
+ADMIN_COMMANDS = frozenset({"report", "fine"})
 
 DAILY_RESET_HOUR = 15
 DAILY_RESET_MIN = 0
@@ -54,9 +66,25 @@ logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=lo
 logger = logging.getLogger(__name__)
 
 # ================= IN-MEMORY STORAGE =================
-group_data: Dict[int, Dict[int, Dict[str, Any]]] = {}
+# One dict per field, keyed by (chat_id, user_id). group_data is the roster
+# (chat_id -> {user_id: display name}) used to walk a single chat's users.
+UserKey = Tuple[int, int]
+group_data: Dict[int, Dict[int, str]] = {}
+USER_LANGS: Dict[UserKey, str] = {}
+WORK_START: Dict[UserKey, float] = {}  # time.monotonic() values
+ACTIVITIES: Dict[UserKey, List[Dict[str, Any]]] = {}
+DAILY_FINES: DefaultDict[UserKey, int] = defaultdict(int)
+MONTHLY_FINES: DefaultDict[UserKey, int] = defaultdict(int)
+# Every write to these tables takes _state_lock (the flush thread reads them).
+# Handlers all run on the one event loop, so a state change that never
+# awaits can't interleave with another update for the same user: keep
+# read-modify-write sections await-free and do Bot API calls after them.
+_state_lock = threading.RLock()
+# Strong refs to in-flight tasks (updates, timers) so they are not GC'd mid-run
+_background_tasks: "set[asyncio.Task]" = set()
 
 # ================= MULTI-LANGUAGE LABELS =================
+LANGS = ("zh", "en", "km")
 NAMES = {
     "work": {"zh": "上班", "en": "Start Work", "km": "ចាប់ផ្តើមការងារ"},
     "off": {"zh": "下班", "en": "End Work", "km": "បញ្ចប់ការងារ"},
@@ -65,30 +93,152 @@ NAMES = {
     "smoke": {"zh": "抽烟", "en": "Smoke", "km": "ជក់បារី"},
     "meeting": {"zh": "会议", "en": "Meeting", "km": "ប្រជុំ"},
     "back": {"zh": "回座", "en": "Back", "km": "ត្រឡប់"},
+    "user": {"zh": "用户", "en": "User", "km": "អ្នកប្រើប្រាស់"},
     "menu_title": {"zh": "请点击下面按钮打卡", "en": "Please tap a button", "km": "សូមចុចប៊ូតុង"},
     "no_activity": {"zh": "⚠️ 您当前没有正在进行的活动。", "en": "⚠️ No activity running.", "km": "⚠️ គ្មានសកម្មភាពកំពុងធ្វើ។"},
 }
 
 # ================= HELPERS =================
-def ensure_user(chat_id: int, user_id: int, name: str):
-    if chat_id not in group_data:
-        group_data[chat_id] = {}
-    users = group_data[chat_id]
-    if user_id not in users:
-        users[user_id] = {
-            "name": name,
-            "activities": [],
-            "daily_fines": 0,
-            "monthly_fines": 0,
-            "lang": "zh",
-            "work_start": None,
-        }
-    return users[user_id]
-
-def format_td(td: datetime.timedelta) -> str:
-    total = int(td.total_seconds())
-    h, m, s = total // 3600, (total % 3600) // 60, total % 60
-    return " ".join([f"{h}h" if h else "", f"{m}m" if m else "", f"{s}s" if s else ""]).strip()
+def ensure_user(chat_id: int, user_id: int, name: str) -> UserKey:
+    key = (chat_id, user_id)
+    # Steady state: known user, no lock and no throwaway dict
+    members = group_data.get(chat_id)
+    if members is not None and user_id in members:
+        return key
+    with _state_lock:
+        members = group_data.setdefault(chat_id, {})
+        if user_id in members:
+            return key
+        members[user_id] = name
+        USER_LANGS[key] = "zh"
+        ACTIVITIES[key] = []
+    save_user(key)
+    return key
+
+def add_fine(key: UserKey, amount: int):
+    with _state_lock:
+        DAILY_FINES[key] += amount
+        MONTHLY_FINES[key] += amount
+    save_user(key)
+
+# ================= PERSISTENCE =================
+# Write-behind journal: handlers only enqueue (sql, params); a daemon thread
+# applies the batch to SQLite (WAL) every STATE_FLUSH_SEC. Start times are
+# monotonic in memory and stored as wall-clock epoch seconds.
+_UPSERT_USER = "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)"
+_DELETE_ACTIVITIES = "DELETE FROM activities WHERE chat_id = ? AND user_id = ?"
+_INSERT_ACTIVITY = "INSERT INTO activities VALUES (?, ?, ?, ?, ?)"
+
+_journal: "queue.Queue[Tuple[str, tuple]]" = queue.Queue()
+_db: Optional[sqlite3.Connection] = None
+_flush_stop = threading.Event()
+_flush_thread: Optional[threading.Thread] = None
+
+def _to_wall(mono: float) -> float:
+    return mono - time.monotonic() + time.time()
+
+def _from_wall(wall: float) -> float:
+    return wall - time.time() + time.monotonic()
+
+def save_user(key: UserKey):
+    chat_id, user_id = key
+    with _state_lock:
+        work_start = WORK_START.get(key)
+        row = (chat_id, user_id, group_data[chat_id][user_id], USER_LANGS.get(key, "zh"),
+               DAILY_FINES.get(key, 0), MONTHLY_FINES.get(key, 0),
+               None if work_start is None else _to_wall(work_start))
+    _journal.put((_UPSERT_USER, row))
+
+def save_activities(key: UserKey):
+    with _state_lock:
+        rows = [(*key, a["type"], _to_wall(a["start"]), a["timed_out"]) for a in ACTIVITIES.get(key, ())]
+    _journal.put((_DELETE_ACTIVITIES, key))
+    for row in rows:
+        _journal.put((_INSERT_ACTIVITY, row))
+
+def open_state_db(path: str = STATE_DB):
+    """Open the state DB and rehydrate the in-memory tables from it."""
+    global _db
+    _db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    _db.execute("PRAGMA journal_mode=WAL")
+    _db.execute("PRAGMA synchronous=NORMAL")
+    _db.execute("""CREATE TABLE IF NOT EXISTS users (
+        chat_id INTEGER, user_id INTEGER, name TEXT, lang TEXT,
+        daily_fines INTEGER, monthly_fines INTEGER, work_start REAL,
+        PRIMARY KEY (chat_id, user_id))""")
+    _db.execute("""CREATE TABLE IF NOT EXISTS activities (
+        chat_id INTEGER, user_id INTEGER, type TEXT, start REAL, timed_out INTEGER NOT NULL DEFAULT 0)""")
+    with _state_lock:
+        for chat_id, user_id, name, lang, daily, monthly, work_start in _db.execute("SELECT * FROM users"):
+            key = (chat_id, user_id)
+            group_data.setdefault(chat_id, {})[user_id] = name
+            USER_LANGS[key] = lang
+            ACTIVITIES[key] = []
+            if daily:
+                DAILY_FINES[key] = daily
+            if monthly:
+                MONTHLY_FINES[key] = monthly
+            if work_start is not None:
+                WORK_START[key] = _from_wall(work_start)
+        for chat_id, user_id, act, start, timed_out in _db.execute(
+                "SELECT chat_id, user_id, type, start, timed_out FROM activities ORDER BY rowid"):
+            if (chat_id, user_id) in ACTIVITIES and act in ACTIVITY_LIMITS:
+                ACTIVITIES[(chat_id, user_id)].append(
+                    {"type": act, "start": _from_wall(start), "timed_out": bool(timed_out)})
+
+def flush_journal():
+    batch = []
+    while True:
+        try:
+            batch.append(_journal.get_nowait())
+        except queue.Empty:
+            break
+    if not batch or _db is None:
+        return
+    try:
+        _db.execute("BEGIN")
+        # consecutive statements with the same SQL go out as one executemany
+        for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+            _db.executemany(sql, [params for _, params in group])
+        _db.execute("COMMIT")
+    except sqlite3.Error:
+        logger.exception("Failed to flush %d state changes", len(batch))
+        if _db.in_transaction:
+            _db.execute("ROLLBACK")
+
+def _flush_loop():
+    while not _flush_stop.wait(STATE_FLUSH_SEC):
+        flush_journal()
+
+def start_state_flusher():
+    global _flush_thread
+    _flush_stop.clear()
+    _flush_thread = threading.Thread(target=_flush_loop, name="state-flush", daemon=True)
+    _flush_thread.start()
+
+def stop_state_flusher():
+    global _db
+    _flush_stop.set()
+    if _flush_thread is not None:
+        _flush_thread.join()
+    flush_journal()
+    if _db is not None:
+        _db.close()
+        _db = None
+
+def format_td(seconds: float) -> str:
+    h, rem = divmod(int(seconds), 3600)
+    m, s = divmod(rem, 60)
+    if h:
+        return f"{h}h {m}m {s}s"
+    if m:
+        return f"{m}m {s}s"
+    return f"{s}s"
+
+def format_report(title: str, chat_id: int, users: Dict[int, str], fines: Dict[UserKey, int]) -> str:
+    lines = [title]
+    lines.extend(f"{name}: {fines.get((chat_id, uid), 0)} 元" for uid, name in users.items())
+    return "\n".join(lines)
 
 def make_inline_menu(lang: str = "zh") -> InlineKeyboardMarkup:
     kb = [
@@ -102,142 +252,333 @@ def make_inline_menu(lang: str = "zh") -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(kb)
 
+# Only a handful of possible menus, so build them once at import
+INLINE_MENUS = {lang: make_inline_menu(lang) for lang in LANGS}
+MENU_TITLES = {lang: NAMES["menu_title"][lang] for lang in LANGS}
+# Same for the timer messages: only the user id varies at fire time
+WARN_TMPL = {
+    (lang, act): f"⚠️ <a href='tg://user?id={{uid}}'>{NAMES['user'][lang]}</a>, 1 minute left for {NAMES[act][lang]}!"
+    for lang in LANGS for act in ACTIVITY_LIMITS
+}
+TIMEOUT_TMPL = {
+    (lang, act): f"⏰ <a href='tg://user?id={{uid}}'>{NAMES['user'][lang]}</a> timeout on {NAMES[act][lang]}! "
+                 f"Fine {ACTIVITY_LIMITS[act]['fine']}元"
+    for lang in LANGS for act in ACTIVITY_LIMITS
+}
+
+def spawn(coro) -> asyncio.Task:
+    """Run `coro` as a task, keeping a strong ref until it finishes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_task_done)
+    return task
+
+def _on_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed", exc_info=task.exception())
+
+def schedule_activity_timers(key: UserKey, activity: Dict[str, Any], elapsed: float = 0.0):
+    """Arm the 1-minute warning and the timeout for an activity `elapsed` seconds in.
+
+    Plain event-loop timers rather than JobQueue jobs: they are per-user,
+    short-lived and usually cancelled by "back" before they fire. An
+    activity that was already fined gets no timers.
+    """
+    if activity["timed_out"]:
+        return None, None
+    loop = asyncio.get_running_loop()
+    act = activity["type"]
+    limit = ACTIVITY_LIMITS[act]["limit_min"] * 60
+    warn_in = limit - 60 - elapsed
+    warn_handle = loop.call_later(warn_in, lambda: spawn(send_warning(key, activity))) if warn_in > 0 else None
+    to_handle = loop.call_later(max(limit - elapsed, 0), lambda: spawn(fire_timeout(key, activity)))
+    return warn_handle, to_handle
+
+def restore_activity_timers():
+    """Re-arm timers for activities rehydrated from the state DB."""
+    now = time.monotonic()
+    with _state_lock:
+        for key, acts in ACTIVITIES.items():
+            for a in acts:
+                a["warn_handle"], a["to_handle"] = schedule_activity_timers(key, a, now - a["start"])
+
+def activity_running(key: UserKey, activity: Dict[str, Any]) -> bool:
+    """True while this exact activity record is still on the user's stack."""
+    return any(a is activity for a in ACTIVITIES.get(key, ()))
+
+def cancel_timer(handle: Optional[asyncio.TimerHandle]):
+    if handle is not None:
+        handle.cancel()  # no-op if it already fired
+
+def cancel_activity_timers():
+    """Disarm every pending warning/timeout; restore_activity_timers() re-arms them on the next start."""
+    with _state_lock:
+        for acts in ACTIVITIES.values():
+            for a in acts:
+                cancel_timer(a["warn_handle"])
+                cancel_timer(a["to_handle"])
+
 # ================= COMMANDS =================
-def cmd_start(update: Update, context: CallbackContext):
-    user = ensure_user(update.effective_chat.id, update.effective_user.id, update.effective_user.full_name)
-    update.message.reply_text(NAMES["menu_title"][user["lang"]], reply_markup=make_inline_menu(user["lang"]))
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    key = ensure_user(update.effective_chat.id, update.effective_user.id, update.effective_user.full_name)
+    lang = USER_LANGS[key]
+    await update.message.reply_text(MENU_TITLES[lang], reply_markup=INLINE_MENUS[lang])
 
-def cmd_set_lang(update: Update, context: CallbackContext, lang: str):
-    u = ensure_user(update.effective_chat.id, update.effective_user.id, update.effective_user.full_name)
-    u["lang"] = lang
-    cmd_start(update, context)
+async def cmd_set_lang(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
+    key = ensure_user(update.effective_chat.id, update.effective_user.id, update.effective_user.full_name)
+    with _state_lock:
+        USER_LANGS[key] = lang
+    save_user(key)
+    await cmd_start(update, context)
 
-def cmd_set_zh(update, context): cmd_set_lang(update, context, "zh")
-def cmd_set_en(update, context): cmd_set_lang(update, context, "en")
-def cmd_set_km(update, context): cmd_set_lang(update, context, "km")
+async def cmd_set_zh(update, context): await cmd_set_lang(update, context, "zh")
+async def cmd_set_en(update, context): await cmd_set_lang(update, context, "en")
+async def cmd_set_km(update, context): await cmd_set_lang(update, context, "km")
 
 # ================= AUTO-LEAVE =================
-def handle_new_chat_members(update: Update, context: CallbackContext):
+async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     bot_id = context.bot.id
     for member in update.message.new_chat_members:
         if member.id == bot_id:  # bot added
             adder = update.message.from_user.id
             if adder not in ADMIN_USER_IDS:
-                context.bot.send_message(chat_id=chat.id, text="⚠️ Only admins can add me. Leaving...")
-                context.bot.leave_chat(chat.id)
+                spawn(warn_and_leave(context.bot, chat.id))
+
+async def warn_and_leave(bot, chat_id: int):
+    await bot.send_message(chat_id=chat_id, text="⚠️ Only admins can add me. Leaving...")
+    await bot.leave_chat(chat_id)
 
 # ================= CALLBACK HANDLER =================
-def button_handler(update: Update, context: CallbackContext):
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user = ensure_user(update.effective_chat.id, query.from_user.id, query.from_user.full_name)
-    now = datetime.datetime.now()
-
-    if query.data == "work":
-        user["work_start"] = now
-        query.answer("✅ Work started")
-    elif query.data == "off":
-        user["work_start"] = None
-        query.answer("✅ Work ended")
-    elif query.data in ACTIVITY_LIMITS:
-        user["activities"].append({"type": query.data, "start": now})
-        query.answer(f"Started {query.data}")
-        limit = ACTIVITY_LIMITS[query.data]["limit_min"]
-        # schedule warning + timeout
-        context.job_queue.run_once(send_warning_job, limit*60 - 60,
-                                   context=(update.effective_chat.id, query.from_user.id, query.data))
-        context.job_queue.run_once(timeout_job, limit*60,
-                                   context=(update.effective_chat.id, query.from_user.id, query.data))
-    elif query.data == "back":
-        if not user["activities"]:
-            query.answer(NAMES["no_activity"][user["lang"]])
-            return
-        last = user["activities"].pop()
-        duration = now - last["start"]
-        query.answer(f"Back from {last['type']} ({format_td(duration)})")
+    key = ensure_user(update.effective_chat.id, query.from_user.id, query.from_user.full_name)
+    answer = apply_button(query.data, key)
+    await query.answer(answer)
+
+def apply_button(data: str, key: UserKey) -> Optional[str]:
+    """Apply one button press to the user's state and return the answer text.
+
+    Synchronous on purpose: a press is applied in full before any other
+    update (or timeout) for the same user gets to run.
+    """
+    now = time.monotonic()  # durations only; immune to wall-clock jumps
+
+    if data == "work":
+        with _state_lock:
+            WORK_START[key] = now
+        save_user(key)
+        return "✅ Work started"
+    if data == "off":
+        with _state_lock:
+            WORK_START.pop(key, None)
+        save_user(key)
+        return "✅ Work ended"
+    if data in ACTIVITY_LIMITS:
+        activity = {"type": data, "start": now, "timed_out": False}
+        # schedule warning + timeout; handles are kept so "back" can cancel them
+        activity["warn_handle"], activity["to_handle"] = schedule_activity_timers(key, activity)
+        with _state_lock:
+            ACTIVITIES[key].append(activity)
+        save_activities(key)
+        return f"Started {data}"
+    if data == "back":
+        with _state_lock:
+            last = ACTIVITIES[key].pop() if ACTIVITIES[key] else None
+        if last is None:
+            return NAMES["no_activity"][USER_LANGS[key]]
+        save_activities(key)
+        cancel_timer(last["warn_handle"])
+        cancel_timer(last["to_handle"])
+        return f"Back from {last['type']} ({format_td(now - last['start'])})"
+    return None
 
 # ================= JOBS =================
-def send_warning_job(context: CallbackContext):
-    chat_id, user_id, act = context.job.context
-    context.bot.send_message(chat_id, f"⚠️ <a href='tg://user?id={user_id}'>User</a>, 1 minute left for {act}!", parse_mode="HTML")
-
-def timeout_job(context: CallbackContext):
-    chat_id, user_id, act = context.job.context
-    user = ensure_user(chat_id, user_id, str(user_id))
-    fine = ACTIVITY_LIMITS[act]["fine"]
-    user["daily_fines"] += fine
-    user["monthly_fines"] += fine
-    context.bot.send_message(chat_id, f"⏰ <a href='tg://user?id={user_id}'>User</a> timeout on {act}! Fine {fine}元", parse_mode="HTML")
-
-def daily_reset_job(context: CallbackContext):
-    for chat_id, users in group_data.items():
-        for u in users.values():
-            u["daily_fines"] = 0
-        context.bot.send_message(chat_id, "🔄 Daily reset complete.")
-
-def monthly_report_job(context: CallbackContext):
-    for chat_id, users in group_data.items():
-        report = "📊 Monthly Report:\n"
-        for u in users.values():
-            report += f"{u['name']}: {u['monthly_fines']} 元\n"
-            u["monthly_fines"] = 0
-        context.bot.send_message(chat_id, report)
+async def broadcast(bot, messages: List[Tuple[int, str]]):
+    """Send all (chat_id, text) pairs concurrently; one failing chat doesn't stop the rest."""
+    results = await asyncio.gather(*(bot.send_message(chat_id, text) for chat_id, text in messages),
+                                   return_exceptions=True)
+    for (chat_id, _), res in zip(messages, results):
+        if isinstance(res, Exception):
+            logger.warning("Failed to send to chat %s: %s", chat_id, res)
+
+async def send_warning(key: UserKey, activity: Dict[str, Any]):
+    with _state_lock:
+        if not activity_running(key, activity):
+            return
+    chat_id, user_id = key
+    text = WARN_TMPL[(USER_LANGS[key], activity["type"])].format(uid=user_id)
+    await bot.send_message(chat_id, text, parse_mode="HTML")
+
+async def fire_timeout(key: UserKey, activity: Dict[str, Any]):
+    # "back" may have popped it; fine at most once (also across restarts)
+    with _state_lock:
+        if activity["timed_out"] or not activity_running(key, activity):
+            return
+        activity["timed_out"] = True
+    add_fine(key, ACTIVITY_LIMITS[activity["type"]]["fine"])
+    save_activities(key)
+    chat_id, user_id = key
+    text = TIMEOUT_TMPL[(USER_LANGS[key], activity["type"])].format(uid=user_id)
+    await bot.send_message(chat_id, text, parse_mode="HTML")
+
+async def daily_reset_job(context: ContextTypes.DEFAULT_TYPE):
+    with _state_lock:
+        DAILY_FINES.clear()
+        chat_ids = list(group_data)
+    _journal.put(("UPDATE users SET daily_fines = 0", ()))
+    await broadcast(context.bot, [(chat_id, "🔄 Daily reset complete.") for chat_id in chat_ids])
+
+async def monthly_report_job(context: ContextTypes.DEFAULT_TYPE):
+    reports = []
+    with _state_lock:
+        for chat_id, users in group_data.items():
+            reports.append((chat_id, format_report("📊 Monthly Report:", chat_id, users, MONTHLY_FINES)))
+        MONTHLY_FINES.clear()
+    _journal.put(("UPDATE users SET monthly_fines = 0", ()))
+    await broadcast(context.bot, reports)
 
 # ================= ADMIN COMMANDS =================
-def cmd_report(update: Update, context: CallbackContext):
+async def cmd_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_USER_IDS:
         return
     chat_id = update.effective_chat.id
-    users = group_data.get(chat_id, {})
-    report = "📊 Daily Report:\n"
-    for u in users.values():
-        report += f"{u['name']}: {u['daily_fines']} 元\n"
-    update.message.reply_text(report)
+    with _state_lock:
+        report = format_report("📊 Daily Report:", chat_id, group_data.get(chat_id, {}), DAILY_FINES)
+    spawn(update.message.reply_text(report))
 
-def cmd_fine(update: Update, context: CallbackContext):
+async def cmd_fine(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_USER_IDS:
         return
     if len(context.args) < 2:
-        update.message.reply_text("Usage: /fine user_id amount")
+        spawn(update.message.reply_text("Usage: /fine user_id amount"))
         return
     uid, amount = int(context.args[0]), int(context.args[1])
-    user = ensure_user(update.effective_chat.id, uid, str(uid))
-    user["daily_fines"] += amount
-    user["monthly_fines"] += amount
-    update.message.reply_text(f"✅ Fine {amount} added to {uid}")
+    add_fine(ensure_user(update.effective_chat.id, uid, str(uid)), amount)
+    # state is already updated; the confirmation doesn't need to hold the handler
+    spawn(update.message.reply_text(f"✅ Fine {amount} added to {uid}"))
 
 # ================= FASTAPI APP =================
-app = FastAPI()
-bot = Bot(BOT_TOKEN)
-dispatcher = Dispatcher(bot, None, workers=0, use_context=True)
+# Reused JSON decoder for raw webhook bodies (much cheaper than stdlib json)
+_json_decoder = msgspec.json.Decoder()
+# Only these update kinds are dispatched; anything else (including
+# edited_message) is acked and dropped
+HANDLED_UPDATE_KEYS = ("message", "callback_query")
+
+def is_unauthorized_admin_command(data: Dict[str, Any]) -> bool:
+    """Cheap pre-check on the raw payload so non-admins' /report and /fine are
+    dropped before an Update (and handler context) is ever built."""
+    msg = data.get("message")
+    if not isinstance(msg, dict):
+        return False
+    text = msg.get("text")
+    if not isinstance(text, str) or not text.startswith("/"):
+        return False
+    parts = text[1:].split(maxsplit=1)
+    command = parts[0].split("@", 1)[0] if parts else ""
+    sender = msg.get("from")
+    sender_id = sender.get("id") if isinstance(sender, dict) else None
+    # ids from a forged payload may be unhashable (lists, dicts)
+    return command in ADMIN_COMMANDS and not (isinstance(sender_id, int) and sender_id in ADMIN_USER_IDS)
+
+# No Updater: updates arrive through the FastAPI webhook below. The bot's
+# httpx client is created once and reused for every Bot API call; HTTP/2
+# multiplexes bursts (broadcasts, replies) over warm TLS connections.
+application = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .updater(None)
+    .http_version("2")
+    .connection_pool_size(TG_CONNECTION_POOL_SIZE)
+    .pool_timeout(TG_POOL_TIMEOUT_SEC)
+    .build()
+)
+bot = application.bot
 
 # Handlers
-dispatcher.add_handler(CommandHandler("start", cmd_start))
-dispatcher.add_handler(CommandHandler("zh", cmd_set_zh))
-dispatcher.add_handler(CommandHandler("en", cmd_set_en))
-dispatcher.add_handler(CommandHandler("km", cmd_set_km))
-dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, handle_new_chat_members))
-dispatcher.add_handler(CallbackQueryHandler(button_handler))
-dispatcher.add_handler(CommandHandler("report", cmd_report))
-dispatcher.add_handler(CommandHandler("fine", cmd_fine))
-
-# Job queue
-job_queue = JobQueue(bot)
-job_queue.set_dispatcher(dispatcher)
-job_queue.run_daily(daily_reset_job, time=datetime.time(hour=DAILY_RESET_HOUR, minute=DAILY_RESET_MIN))
-job_queue.run_monthly(monthly_report_job, day=MONTHLY_REPORT_DAY,
-                      time=datetime.time(hour=MONTHLY_REPORT_HOUR, minute=MONTHLY_REPORT_MIN))
-job_queue.start()
-
-@app.on_event("startup")
-async def startup_event():
-    await bot.set_webhook(WEBHOOK_URL)
+application.add_handler(CommandHandler("start", cmd_start))
+application.add_handler(CommandHandler("zh", cmd_set_zh))
+application.add_handler(CommandHandler("en", cmd_set_en))
+application.add_handler(CommandHandler("km", cmd_set_km))
+application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_chat_members))
+application.add_handler(CallbackQueryHandler(button_handler))
+application.add_handler(CommandHandler("report", cmd_report))
+application.add_handler(CommandHandler("fine", cmd_fine))
+
+def schedule_cron_jobs(job_queue):
+    job_queue.run_daily(daily_reset_job, time=datetime.time(hour=DAILY_RESET_HOUR, minute=DAILY_RESET_MIN))
+    job_queue.run_monthly(monthly_report_job, day=MONTHLY_REPORT_DAY,
+                          when=datetime.time(hour=MONTHLY_REPORT_HOUR, minute=MONTHLY_REPORT_MIN))
+
+async def drain_background_tasks(timeout: float = SHUTDOWN_DRAIN_SEC):
+    """Let in-flight updates finish before the bot's HTTP client is closed.
+
+    Updates are acked before they run, so Telegram never redelivers one
+    that is cut off here; anything still running after `timeout` is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # loop: finishing tasks may spawn new ones (e.g. replies)
+    while _background_tasks and loop.time() < deadline:
+        await asyncio.wait(set(_background_tasks), timeout=deadline - loop.time())
+    for task in set(_background_tasks):
+        task.cancel()
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+@contextlib.asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Nothing is scheduled or started at import; the job queue only runs
+    # while the server is up (initialize/start also start it on this loop).
+    # Each teardown is registered as soon as its step succeeds, so a failed
+    # startup (e.g. set_webhook on a bad WEBHOOK_URL) still unwinds cleanly;
+    # callbacks run in reverse, so pending timers are disarmed and in-flight
+    # updates drain before stop().
+    async with contextlib.AsyncExitStack() as stack:
+        stack.callback(stop_state_flusher)
+        open_state_db()
+        start_state_flusher()
+        schedule_cron_jobs(application.job_queue)
+        restore_activity_timers()
+        await application.initialize()
+        stack.push_async_callback(application.shutdown)
+        await application.start()
+        stack.push_async_callback(application.stop)
+        stack.push_async_callback(drain_background_tasks)
+        stack.callback(cancel_activity_timers)
+        await bot.set_webhook(WEBHOOK_URL)
+        yield
+
+app = FastAPI(lifespan=lifespan)
+
+@app.get("/")
+async def health():
+    return {"status": "ok"}
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    data = await request.json()
-    update = Update.de_json(data, bot)
-    dispatcher.process_update(update)
+    try:
+        data = _json_decoder.decode(await request.body())
+    except msgspec.DecodeError:
+        logger.warning("Dropping malformed webhook payload")
+        return {"ok": True}
+    if (not isinstance(data, dict) or not any(k in data for k in HANDLED_UPDATE_KEYS)
+            or is_unauthorized_admin_command(data)):
+        return {"ok": True}
+    try:
+        update = Update.de_json(data, bot)
+    except Exception:  # well-formed JSON that isn't a valid Update
+        logger.warning("Dropping malformed webhook update")
+        return {"ok": True}
+    # Ack Telegram right away; handlers run as their own task on this loop,
+    # so one slow update never holds up the response or other users.
+    spawn(application.process_update(update))
     return {"ok": True}
 
-# Run with: uvicorn main:app --host 0.0.0.0 --port 8000
+if __name__ == "__main__":
+    import uvicorn
+    # As in the Procfile, but "auto" so a local run without uvloop (Windows)
+    # falls back to asyncio instead of failing at startup
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")),
+                loop="auto", http="httptools", access_log=False)